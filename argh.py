@@ -1,126 +1,107 @@
 import sys
 import time
-
-class Position:
-    '''
-        A position is just a place in the Codebox, a coordinate.
-        Made to override some operators as + and < for smoother
-        code integration.
-    '''
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
-
-    def __str__(self):
-        return f"{self.y + 1}, {self.x + 1}"
-
-    def __add__(self, other):
-        if type(other) == Direction:
-            return Position(self.x + other.xoffset, self.y + other.yoffset)
-        if type(other == Position):
-            return Position(self.x + other.x, self.y +  other.y)
-
-    def __lt__(self, other):
-        if type(other) == Direction:
-            return self.x < other.xoffset or self.y < other.yoffset
-        if type(other == Position):
-            return self.x < other.x or self.y < other.y
-
-    def __IADD__(self, other):
-        if type(other) == Direction:
-            return Position(self.x + other.xoffset, self.y + other.yoffset)
-        if type(other == Position):
-            return Position(self.x + other.x, self.y +  other.y)
-
-
-class Direction:
-    '''
-        A Direction is an offset to an position that the
-        interpreter can use to read the next instruction
-        in that direction.
-        Used to override some operators just as in Position
-    '''
-    def __init__(self, xoffset, yoffset):
-        self.xoffset = xoffset
-        self.yoffset = yoffset
-
-    def __add__(self, other):
-        if type(other) == Direction:
-            return Direction(self.xoffset + other.xoffset, self.yoffset + other.yoffset)
-        if type(other == Position):
-            return Position(self.xoffset + other.x, self.yoffset +  other.y)
-
-    def __IADD__(self, other):
-        if type(other) == Direction:
-            return Direction(self.xoffset + other.xoffset, self.yoffset + other.yoffset)
-        if type(other == Position):
-            return Position(self.xoffset + other.x, self.yoffset +  other.y)
+from array import array
 
 # Some constants that the instructions and interpreter will use
 
 EOF_CHAR = '\0'
 SLOW = False
-NORTH = Direction( 0, -1 )
-EAST  = Direction( 1,  0 )
-SOUTH = Direction( 0,  1 )
-WEST  = Direction(-1,  0 )
+# Compile the interpreter loop with Numba, if it is installed.
+# Only pays off for long running programs, importing Numba and
+# loading the compiled loop take longer than most scripts run.
+JIT = False
+
+numba = None
+if JIT:
+    try:
+        import numba
+        import numpy
+    except ImportError:
+        pass
+
+# Directions are numbered clockwise, so turning right is
+# (dir + 1) & 3 and turning left (dir - 1) & 3. XOFFSET and
+# YOFFSET hold what the interpreter moves by each step.
+NORTH, EAST, SOUTH, WEST = range(4)
+XOFFSET = ( 0, 1, 0, -1)
+YOFFSET = (-1, 0, 1,  0)
 
 # Instructions
 
+# Opcodes, resolved once per cell when the Codebox is built.
+# NONE is everything that is not a runnable instruction. The
+# lower and uppercase letter of an instruction get an opcode
+# each so the handlers never have to look at the case.
+# The moves are ordered by direction, lower before upper.
+
+(NONE,
+ MOVE_NORTH_LOWER, MOVE_NORTH_UPPER,
+ MOVE_EAST_LOWER, MOVE_EAST_UPPER,
+ MOVE_SOUTH_LOWER, MOVE_SOUTH_UPPER,
+ MOVE_WEST_LOWER, MOVE_WEST_UPPER,
+ STACK_ADD_LOWER, STACK_ADD_UPPER,
+ STACK_REDUCE_LOWER, STACK_REDUCE_UPPER,
+ STACK_DUPE, STACK_DROP,
+ STACK_APPEND_LOWER, STACK_APPEND_UPPER,
+ CODEBOX_CHANGE_LOWER, CODEBOX_CHANGE_UPPER,
+ CODEBOX_EOF_LOWER, CODEBOX_EOF_UPPER,
+ USERINPUT_LOWER, USERINPUT_UPPER,
+ PRINT_LOWER, PRINT_UPPER,
+ TURN_RIGHT, TURN_LEFT,
+ SHEBANG, QUIT) = range(29)
+
 class Instruction:
     '''
         Base class of an instruction. If there is and instance
         of this class it means that it is not an instruction
         that is runnable (whitespace, symbols etc.). Therefor
-        if it is executed it will raise an exception.
+        if it is executed the interpreter will argh.
+        There is one shared instance per opcode.
     '''
-    def __init__(self, char_value):
-        self.char_value = char_value
-
     def handle(self, interpreter):
-        raise Exception()
-
-    def __str__(self):
-        return chr(self.char_value)
+        interpreter.argh()
 
 class MoveInstruction(Instruction):
     '''
         Base class of a move instruction. Should not be directly
         instanced anywhere. Will make the interpreter change the
-        direction to the specifyed direction. If the move
-        instruction is an uppercase one, we will continue until
-        the current position constains the same char as on the
-        top of the stack.
-    '''
-    def handle(self, interpreter, dir):
-        if chr(self.char_value).islower():
-            interpreter.dir = dir
-        else:
-            interpreter.dir = dir
-            interpreter.advance()
-            while interpreter.get_current_instruction().char_value != interpreter.stack.peek():
-                interpreter.advance()
+        direction to the specifyed direction.
+    '''
+    def __init__(self, dir):
+        self.dir = dir
 
 # The instanceable MoveInstructions
-class MoveNorth(MoveInstruction):
-    def handle(self, interpreter):
-        super().handle(interpreter, NORTH)
-
-class MoveWest(MoveInstruction):
+class Move(MoveInstruction):
+    '''
+        Lowercase h, j, k, l
+    '''
     def handle(self, interpreter):
-        super().handle(interpreter, WEST)
+        interpreter.dir = self.dir
 
-class MoveSouth(MoveInstruction):
+class MoveUntil(MoveInstruction):
+    '''
+        Uppercase H, J, K, L. We will continue until the current
+        position constains the same char as on the top of the stack.
+    '''
     def handle(self, interpreter):
-        super().handle(interpreter, SOUTH)
+        interpreter.dir = self.dir
+        interpreter.x, interpreter.y = interpreter.code_box.find(
+            interpreter.x, interpreter.y, self.dir, interpreter.stack[-1])
 
-class MoveEast(MoveInstruction):
-    def handle(self, interpreter):
-        super().handle(interpreter, EAST)
+class OperandInstruction(Instruction):
+    '''
+        Base class of the instructions that use the cell above
+        (uppercase) or below (lowercase) them. The case is
+        resolved when the Codebox is built, every case is an
+        instance of its own that only knows the direction of
+        its operand.
+    '''
+    def __init__(self, dir):
+        self.dir = dir
 
 # Stack instructions
 
-class StackAdd(Instruction):
+class StackAdd(OperandInstruction):
     '''
         Will sum up the value of the character above
         (in case of uppercase instruction) or below
@@ -128,14 +109,10 @@ class StackAdd(Instruction):
         and the top value of the stack
     '''
     def handle(self, interpreter):
-        if chr(self.char_value).islower():
-            value = interpreter.stack.pop() + interpreter.get_instruction_at(SOUTH).char_value
-        else:
-            value = interpreter.stack.pop() + interpreter.get_instruction_at(NORTH).char_value
-
+        value = interpreter.stack.pop() + interpreter.get_char_at(self.dir)
         interpreter.stack.append(value)
 
-class StackReduce(Instruction):
+class StackReduce(OperandInstruction):
     '''
         Will take the differance of the character above
         (in case of uppercase instruction) or below
@@ -143,16 +120,12 @@ class StackReduce(Instruction):
         and the top value of the stack
     '''
     def handle(self, interpreter):
-        if chr(self.char_value).islower():
-            value = interpreter.stack.pop() - interpreter.get_instruction_at(SOUTH).char_value
-        else:
-            value = interpreter.stack.pop() - interpreter.get_instruction_at(NORTH).char_value
-
+        value = interpreter.stack.pop() - interpreter.get_char_at(self.dir)
         interpreter.stack.append(value)
 
-class StackDropDupe(Instruction):
+class StackDupe(Instruction):
     '''
-        Duplicates the top value of the stack
+        Duplicates the top value of the stack (lowercase d)
         ( Example:
 
             if stack == [5]:
@@ -160,13 +133,17 @@ class StackDropDupe(Instruction):
         )
     '''
     def handle(self, interpreter):
-        if chr(self.char_value).islower():
-            value = interpreter.stack.peek()
-            interpreter.stack.append(value)
-        else:
-            interpreter.stack.pop()
+        value = interpreter.stack[-1]
+        interpreter.stack.append(value)
 
-class StackAppend(Instruction):
+class StackDrop(Instruction):
+    '''
+        Drops the top value of the stack (uppercase D)
+    '''
+    def handle(self, interpreter):
+        interpreter.stack.pop()
+
+class StackAppend(OperandInstruction):
     '''
         Append (usually called push) the value
         of the character above or below the
@@ -174,14 +151,9 @@ class StackAppend(Instruction):
         the instruction letter.
     '''
     def handle(self, interpreter):
-        if chr(self.char_value).islower():
-            value = interpreter.get_instruction_at(SOUTH).char_value
-        else:
-            value = interpreter.get_instruction_at(NORTH).char_value
+        interpreter.stack.append(interpreter.get_char_at(self.dir))
 
-        interpreter.stack.append(value)
-
-class CodeboxChange(Instruction):
+class CodeboxChange(OperandInstruction):
     '''
         Push the value on top of the stack into
         the codebox above or below the instruction
@@ -190,11 +162,7 @@ class CodeboxChange(Instruction):
         in the Codebox.
     '''
     def handle(self, interpreter):
-        value = interpreter.stack.pop()
-        if chr(self.char_value).islower():
-            interpreter.set_instruction_at(SOUTH, instruction_create(value))
-        else:
-            interpreter.set_instruction_at(NORTH, instruction_create(value))
+        interpreter.set_instruction_at(self.dir, interpreter.stack.pop())
 
 class CodeboxEOF(CodeboxChange):
     '''
@@ -214,41 +182,55 @@ class Userinput(CodeboxChange):
     '''
         Takes the Userinput and places it in a buffer
         that we take one letter from at a time until
-        it is empty.
-        FIXME: Make Userinput able to take more than one input
-        at a time. If the buffer is empty and we encounter another
-        Userinput, we will crash (check test/input.agh)
+        it is empty. Every line read ends with an EOF
+        character, once the buffer is empty the next line
+        is read. When stdin is closed there is only EOF.
+        Lines are decoded like input() does, so a character
+        is one value however many bytes it is encoded in.
     '''
     def handle(self, interpreter):
-        if interpreter.input == None:
-            interpreter.input = list(input())
-            interpreter.input.append(EOF_CHAR)
-
-        interpreter.stack.append(ord(interpreter.input.pop(0)))
+        if interpreter.input_pos == len(interpreter.input):
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+            interpreter.input = line.rstrip("\r\n") + EOF_CHAR
+            interpreter.input_pos = 0
+
+        interpreter.stack.append(ord(interpreter.input[interpreter.input_pos]))
+        interpreter.input_pos += 1
         super().handle(interpreter)
 
-class Print(Instruction):
+class Print(OperandInstruction):
+    '''
+        Prints the character above or below the instruction.
+        Cells hold decoded characters of the program and of
+        the input, so they are written as text and not bytes.
+        Output is not flushed per character, stdout flushes it
+        by itself (per line on a terminal) and at the latest
+        when the interpreter stops or waits for Userinput.
+    '''
     def handle(self, interpreter):
-        if chr(self.char_value).islower():
-            value = interpreter.get_instruction_at(SOUTH).char_value
-        else:
-            value = interpreter.get_instruction_at(NORTH).char_value
-        print(chr(value), end="", flush = True)
+        interpreter.write(chr(interpreter.get_char_at(self.dir)))
+
+class TurnRight(Instruction):
+    '''
+        Turns right if the top of the stack is positive (lowercase x)
+    '''
+    def handle(self, interpreter):
+        if interpreter.stack[-1] > 0:
+            interpreter.turn_right()
 
-class Turn(Instruction):
+class TurnLeft(Instruction):
+    '''
+        Turns left if the top of the stack is negative (uppercase X)
+    '''
     def handle(self, interpreter):
-        top_value = interpreter.stack.peek()
-        if chr(self.char_value).islower():
-            if top_value > 0:
-                interpreter.turn_right()
-        else:
-            if top_value < 0:
-                interpreter.turn_left()
+        if interpreter.stack[-1] < 0:
+            interpreter.turn_left()
 
 class Shebang(Instruction):
     def handle(self, interpreter):
-        if interpreter.position == Position():
-            if interpreter.get_instruction_at(EAST).char_value == ord('!'):
+        if interpreter.x == 0 and interpreter.y == 0:
+            if interpreter.get_char_at(EAST) == ord('!'):
                 interpreter.dir = SOUTH
         else:
             super().handle(interpreter)
@@ -258,155 +240,522 @@ class Quit(Instruction):
         interpreter.running = False
 
 def instruction_create(char_value):
-    try:
-        if chr(char_value).lower() == 'h':
-            return MoveWest(char_value)
-        elif chr(char_value).lower() == 'j':
-            return MoveSouth(char_value)
-        elif chr(char_value).lower() == 'k':
-            return MoveNorth(char_value)
-        elif chr(char_value).lower() == 'l':
-            return MoveEast(char_value)
-        elif chr(char_value).lower() == 'a':
-            return StackAdd(char_value)
-        elif chr(char_value).lower() == 'r':
-            return StackReduce(char_value)
-        elif chr(char_value).lower() == 'd':
-            return StackDropDupe(char_value)
-        elif chr(char_value).lower() == 's':
-            return StackAppend(char_value)
-        elif chr(char_value).lower() == 'f':
-            return CodeboxChange(char_value)
-        elif chr(char_value).lower() == 'e':
-            return CodeboxEOF(char_value)
-        elif chr(char_value).lower() == 'g':
-            return Userinput(char_value)
-        elif chr(char_value).lower() == 'p':
-            return Print(char_value)
-        elif chr(char_value).lower() == 'x':
-            return Turn(char_value)
-        elif chr(char_value).lower() == '#':
-            return Shebang(char_value)
-        elif chr(char_value).lower() == 'q':
-            return Quit(char_value)
-        else:
-            return Instruction(char_value)
-    except ValueError:
-        return Instruction(char_value)
+    # Only ASCII letters are instructions, str.lower would
+    # also turn the Kelvin sign (U+212A) into a k
+    if not 0 <= char_value < 128:
+        return NONE
+
+    char = chr(char_value)
+    lower = char.islower()
+    char = char.lower()
+    if char == 'h':
+        return MOVE_WEST_LOWER if lower else MOVE_WEST_UPPER
+    elif char == 'j':
+        return MOVE_SOUTH_LOWER if lower else MOVE_SOUTH_UPPER
+    elif char == 'k':
+        return MOVE_NORTH_LOWER if lower else MOVE_NORTH_UPPER
+    elif char == 'l':
+        return MOVE_EAST_LOWER if lower else MOVE_EAST_UPPER
+    elif char == 'a':
+        return STACK_ADD_LOWER if lower else STACK_ADD_UPPER
+    elif char == 'r':
+        return STACK_REDUCE_LOWER if lower else STACK_REDUCE_UPPER
+    elif char == 'd':
+        return STACK_DUPE if lower else STACK_DROP
+    elif char == 's':
+        return STACK_APPEND_LOWER if lower else STACK_APPEND_UPPER
+    elif char == 'f':
+        return CODEBOX_CHANGE_LOWER if lower else CODEBOX_CHANGE_UPPER
+    elif char == 'e':
+        return CODEBOX_EOF_LOWER if lower else CODEBOX_EOF_UPPER
+    elif char == 'g':
+        return USERINPUT_LOWER if lower else USERINPUT_UPPER
+    elif char == 'p':
+        return PRINT_LOWER if lower else PRINT_UPPER
+    elif char == 'x':
+        return TURN_RIGHT if lower else TURN_LEFT
+    elif char == '#':
+        return SHEBANG
+    elif char == 'q':
+        return QUIT
+    else:
+        return NONE
+
+# One shared instance per opcode, indexed by the opcode.
+# Lowercase instructions work on the cell below them (SOUTH),
+# uppercase ones on the cell above them (NORTH).
+INSTRUCTIONS = (
+    Instruction(),
+    Move(NORTH), MoveUntil(NORTH),
+    Move(EAST), MoveUntil(EAST),
+    Move(SOUTH), MoveUntil(SOUTH),
+    Move(WEST), MoveUntil(WEST),
+    StackAdd(SOUTH), StackAdd(NORTH),
+    StackReduce(SOUTH), StackReduce(NORTH),
+    StackDupe(), StackDrop(),
+    StackAppend(SOUTH), StackAppend(NORTH),
+    CodeboxChange(SOUTH), CodeboxChange(NORTH),
+    CodeboxEOF(SOUTH), CodeboxEOF(NORTH),
+    Userinput(SOUTH), Userinput(NORTH),
+    Print(SOUTH), Print(NORTH),
+    TurnRight(), TurnLeft(),
+    Shebang(), Quit(),
+)
 
 class Codebox:
-    code_box = list()
+    '''
+        The Codebox is stored flat, row after row, in two
+        arrays of width * height cells. chars holds the value
+        of every cell and ops the opcode that instruction_create
+        resolved for it when it was written. chars is a signed
+        array and not a bytearray since programs are allowed
+        to write any stack value (negative ones too) into it.
+        handlers caches the handler of every cell for the
+        interpreted loop and cols holds a copy of chars column
+        by column for find. Both are kept up to date by
+        set_instruction_at, run_loop only writes chars and ops
+        so run_compiled calls sync once it is done.
+        The code box is given as a list of decoded rows, every
+        character is one cell and shorter rows are padded with
+        spaces.
+    '''
     def __init__(self, code_box):
-        width = 0
-        for i, line in enumerate(code_box):
-            row = list()
-            for j, char in enumerate(line):
-                row.append(instruction_create(ord(char)))
-            width = max(width, len(row))
-            self.code_box.append(row)
-
-        for line in self.code_box:
-            while len(line) < width:
-                line.append(instruction_create(ord(' ')))
-
-    def get_instruction_at(self, position):
-
-        if position < Position():
-            interpreter.argh()
-        retult = None
-        try:
-            result = self.code_box[position.y][position.x]
-        except IndexError:
-            interpreter.argh()
-
-
-        return result
-
-    def set_instruction_at(self, position, instruction):
-        self.code_box[position.y][position.x] = instruction
-
-    def __str__(self):
-        s = ""
-        for line in self.code_box:
-            for instruction in line:
-                s += str(instruction)
-
-        return s
-
-class Stack:
-    def __init__(self, stack=list()):
-        self.stack = stack
-
-    def append(self, item):
-        self.stack.append(item)
-
-    def pop(self, index=-1):
-        return self.stack.pop(index)
-
-    def peek(self, index=-1):
-        return self.stack[index]
+        self.width = max(map(len, code_box), default=0)
+        self.height = len(code_box)
+        self.chars = array("q", map(ord, "".join(row.ljust(self.width) for row in code_box)))
+        self.ops = bytearray(map(instruction_create, self.chars))
+        self.sync()
+
+    def sync(self):
+        '''
+            Rebuilds handlers and cols from ops and chars.
+        '''
+        self.handlers = [INSTRUCTIONS[op].handle for op in self.ops]
+        self.cols = [self.chars[x::self.width] for x in range(self.width)]
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def index(self, x, y):
+        if not self.contains(x, y):
+            raise IndexError("Position outside of the Codebox")
+
+        return y * self.width + x
+
+    def find(self, x, y, dir, char_value):
+        '''
+            Returns the position of the first cell after (x, y)
+            in direction dir that holds char_value. Rows and
+            columns are both searched with array.index.
+            Raises ValueError if there is none.
+        '''
+        row = y * self.width
+        col = self.cols[x]
+        if dir == EAST:
+            return self.chars.index(char_value, row + x + 1, row + self.width) - row, y
+        elif dir == WEST:
+            cells = self.chars[row:row + x]
+            cells.reverse()
+            return x - 1 - cells.index(char_value), y
+        elif dir == SOUTH:
+            return x, col.index(char_value, y + 1)
+        else:
+            cells = col[:y]
+            cells.reverse()
+            return x, y - 1 - cells.index(char_value)
 
-    def __len__(self):
-        return len(self.stack)
+    def set_instruction_at(self, x, y, char_value):
+        i = self.index(x, y)
+        self.chars[i] = char_value
+        self.ops[i] = instruction_create(char_value)
+        self.handlers[i] = INSTRUCTIONS[self.ops[i]].handle
+        self.cols[x][y] = char_value
 
     def __str__(self):
-        return str(self.stack)
-
+        return "\n".join(
+            "".join(map(chr, self.chars[y * self.width:(y + 1) * self.width]))
+            for y in range(self.height))
+
+# Compiled interpreter loop
+
+# Why run_loop handed control back to the interpreter
+JIT_QUIT, JIT_ARGH, JIT_HANDLE, JIT_STACK_FULL, JIT_YIELD = range(5)
+
+# Steps run_loop takes before it hands back, so that Python gets
+# to handle signals (Ctrl-C) even in loops that never do IO
+JIT_STEPS = 1 << 20
+
+# Bounds of the int64 stack, Python raises OverflowError past
+# these and run_loop checks for them itself
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+# Opcode of every ASCII char value, the rest are all NONE
+OPCODE_TABLE = bytes(map(instruction_create, range(128)))
+
+if numba is None:
+    run_loop = None
+else:
+    @numba.njit(cache=True)
+    def _operand(width, height, x, y, yoffset):
+        '''
+            Index of the cell above or below (x, y),
+            -1 if that is outside of the Codebox.
+        '''
+        y += yoffset
+        if y < 0 or y >= height:
+            return -1
+        return y * width + x
+
+    @numba.njit(cache=True)
+    def run_loop(ops, chars, width, height, table, stack, sp, x, y, dir):
+        '''
+            The interpreter loop compiled by Numba. Works on the
+            Codebox arrays in place and keeps the stack in a fixed
+            size int64 array. Returns (reason, sp, x, y, dir)
+            when the program quits or arghs, when the stack is full,
+            when an instruction doing IO (JIT_HANDLE) is next,
+            which the interpreter then runs in Python, and after
+            JIT_STEPS steps (JIT_YIELD).
+            An addition or subtraction that overflows the stack
+            value arghs, just like it does in Python.
+        '''
+        for _ in range(JIT_STEPS):
+            if x < 0 or y < 0 or x >= width or y >= height:
+                return JIT_ARGH, sp, x, y, dir
+            if sp == len(stack):
+                return JIT_STACK_FULL, sp, x, y, dir
+
+            i = y * width + x
+            op = ops[i]
+            if MOVE_NORTH_LOWER <= op <= MOVE_WEST_UPPER:
+                dir = (op - MOVE_NORTH_LOWER) >> 1
+                if (op - MOVE_NORTH_LOWER) & 1:
+                    if sp == 0:
+                        return JIT_ARGH, sp, x, y, dir
+                    x += XOFFSET[dir]
+                    y += YOFFSET[dir]
+                    while True:
+                        if x < 0 or y < 0 or x >= width or y >= height:
+                            return JIT_ARGH, sp, x, y, dir
+                        if chars[y * width + x] == stack[sp - 1]:
+                            break
+                        x += XOFFSET[dir]
+                        y += YOFFSET[dir]
+            elif op == STACK_ADD_LOWER or op == STACK_ADD_UPPER:
+                j = _operand(width, height, x, y, 1 if op == STACK_ADD_LOWER else -1)
+                if sp == 0 or j < 0:
+                    return JIT_ARGH, sp, x, y, dir
+                value = chars[j]
+                if value > 0 and stack[sp - 1] > INT64_MAX - value:
+                    return JIT_ARGH, sp, x, y, dir
+                if value < 0 and stack[sp - 1] < INT64_MIN - value:
+                    return JIT_ARGH, sp, x, y, dir
+                stack[sp - 1] += value
+            elif op == STACK_REDUCE_LOWER or op == STACK_REDUCE_UPPER:
+                j = _operand(width, height, x, y, 1 if op == STACK_REDUCE_LOWER else -1)
+                if sp == 0 or j < 0:
+                    return JIT_ARGH, sp, x, y, dir
+                value = chars[j]
+                if value < 0 and stack[sp - 1] > INT64_MAX + value:
+                    return JIT_ARGH, sp, x, y, dir
+                if value > 0 and stack[sp - 1] < INT64_MIN + value:
+                    return JIT_ARGH, sp, x, y, dir
+                stack[sp - 1] -= value
+            elif op == STACK_DUPE:
+                if sp == 0:
+                    return JIT_ARGH, sp, x, y, dir
+                stack[sp] = stack[sp - 1]
+                sp += 1
+            elif op == STACK_DROP:
+                if sp == 0:
+                    return JIT_ARGH, sp, x, y, dir
+                sp -= 1
+            elif op == STACK_APPEND_LOWER or op == STACK_APPEND_UPPER:
+                j = _operand(width, height, x, y, 1 if op == STACK_APPEND_LOWER else -1)
+                if j < 0:
+                    return JIT_ARGH, sp, x, y, dir
+                stack[sp] = chars[j]
+                sp += 1
+            elif (op == CODEBOX_CHANGE_LOWER or op == CODEBOX_CHANGE_UPPER
+                  or op == CODEBOX_EOF_LOWER or op == CODEBOX_EOF_UPPER):
+                lower = op == CODEBOX_CHANGE_LOWER or op == CODEBOX_EOF_LOWER
+                j = _operand(width, height, x, y, 1 if lower else -1)
+                if op == CODEBOX_EOF_LOWER or op == CODEBOX_EOF_UPPER:
+                    value = ord(EOF_CHAR)
+                elif sp == 0:
+                    return JIT_ARGH, sp, x, y, dir
+                else:
+                    sp -= 1
+                    value = stack[sp]
+                if j < 0:
+                    return JIT_ARGH, sp, x, y, dir
+                chars[j] = value
+                ops[j] = table[value] if 0 <= value < len(table) else NONE
+            elif op == TURN_RIGHT or op == TURN_LEFT:
+                if sp == 0:
+                    return JIT_ARGH, sp, x, y, dir
+                if op == TURN_RIGHT and stack[sp - 1] > 0:
+                    dir = (dir + 1) & 3
+                elif op == TURN_LEFT and stack[sp - 1] < 0:
+                    dir = (dir - 1) & 3
+            elif op == SHEBANG:
+                if x == 0 and y == 0 and width > 1 and chars[1] == ord('!'):
+                    dir = SOUTH
+                else:
+                    return JIT_ARGH, sp, x, y, dir
+            elif op == QUIT:
+                return JIT_QUIT, sp, x, y, dir
+            elif op == NONE:
+                return JIT_ARGH, sp, x, y, dir
+            else:
+                return JIT_HANDLE, sp, x, y, dir
+
+            x += XOFFSET[dir]
+            y += YOFFSET[dir]
+
+        return JIT_YIELD, sp, x, y, dir
+
+# Specialized code for programs that never change their Codebox
+
+# Instructions that write into the Codebox. Programs without
+# them can be turned into Python code ahead of running them.
+SELF_MODIFYING = frozenset((
+    CODEBOX_CHANGE_LOWER, CODEBOX_CHANGE_UPPER,
+    CODEBOX_EOF_LOWER, CODEBOX_EOF_UPPER,
+    USERINPUT_LOWER, USERINPUT_UPPER,
+))
+
+# A state is (y * width + x) * 4 + dir
+QUIT_STATE = -1
+# Most cells a single block runs through before it hands back
+BLOCK_LIMIT = 1000
+
+def compile_block(code_box, state, namespace):
+    '''
+        Turns the straight path that starts at state into a Python
+        function block(stack, push, pop) that returns the next state.
+        The Codebox never changes, so directions, operands and
+        printed text are all baked into the code and only the stack
+        is left for runtime. A block ends where the path depends on
+        the stack (turns and uppercase moves), on quit, on argh and
+        when it comes back to a state it has already passed.
+    '''
+    width, height = code_box.width, code_box.height
+    i, d = divmod(state, 4)
+    y, x = divmod(i, width)
+    lines = []
+    text = []
+    seen = set()
+
+    def state_after(x, y, d):
+        x += XOFFSET[d]
+        y += YOFFSET[d]
+        if x < 0 or y < 0 or x >= width or y >= height:
+            return "argh()"
+        return f"return {(y * width + x) * 4 + d}"
+
+    def emit(line):
+        if text:
+            lines.append(f"write({''.join(text)!r})")
+            text.clear()
+        lines.append(line)
+
+    while True:
+        if x < 0 or y < 0 or x >= width or y >= height:
+            emit("argh()")
+            break
+        state = (y * width + x) * 4 + d
+        if state in seen or len(seen) == BLOCK_LIMIT:
+            emit(f"return {state}")
+            break
+        seen.add(state)
+
+        i = y * width + x
+        op = code_box.ops[i]
+        instruction = INSTRUCTIONS[op]
+        operand = None
+        if isinstance(instruction, OperandInstruction) and 0 <= y + YOFFSET[instruction.dir] < height:
+            operand = code_box.chars[i + YOFFSET[instruction.dir] * width]
+
+        if isinstance(instruction, MoveInstruction):
+            d = instruction.dir
+            if isinstance(instruction, MoveUntil):
+                emit(f"return find({x}, {y}, {d}, stack[-1])")
+                break
+        elif op == TURN_RIGHT or op == TURN_LEFT:
+            turned = (d + 1) & 3 if op == TURN_RIGHT else (d - 1) & 3
+            emit(f"if stack[-1] {'>' if op == TURN_RIGHT else '<'} 0:")
+            emit(f"    {state_after(x, y, turned)}")
+        elif op == SHEBANG and x == 0 and y == 0 and width > 1 and code_box.chars[1] == ord('!'):
+            d = SOUTH
+        elif op == QUIT:
+            emit(f"return {QUIT_STATE}")
+            break
+        elif op == STACK_DUPE:
+            emit("push(stack[-1])")
+        elif op == STACK_DROP:
+            emit("pop()")
+        elif op in SELF_MODIFYING or not isinstance(instruction, OperandInstruction) or operand is None:
+            emit("argh()")
+            break
+        elif isinstance(instruction, StackAdd):
+            emit(f"stack[-1] += {operand}")
+        elif isinstance(instruction, StackReduce):
+            emit(f"stack[-1] -= {operand}")
+        elif isinstance(instruction, StackAppend):
+            emit(f"push({operand})")
+        elif isinstance(instruction, Print):
+            text.append(chr(operand))
+
+        x += XOFFSET[d]
+        y += YOFFSET[d]
+
+    source = "def block(stack, push, pop):\n" + "".join(f"    {line}\n" for line in lines)
+    exec(compile(source, "<argh>", "exec"), namespace)
+    return namespace.pop("block")
 
 class Interpreter:
     def __init__(self, code_box):
         self.code_box = Codebox(code_box)
+        self.x, self.y = 0, 0
         self.dir = EAST
-        self.position = Position()
-        self.stack = Stack()
-        self.input = None
+        # Unboxed signed 64 bit values, same as the Codebox cells
+        self.stack = array("q")
+        self.input = ""
+        self.input_pos = 0
         self.running = False
+        self.write = sys.stdout.write
+        # Handler of every opcode, indexed by the opcode
+        self._dispatch = tuple(instruction.handle for instruction in INSTRUCTIONS)
 
     def run(self):
+        '''
+            Runs until a Quit instruction is hit. Steps outside of
+            the Codebox are checked for and argh right away. A stack
+            underflow or an unprintable value is not checked on
+            every step, those surface as an exception that ends the
+            program with argh.
+            The first of these that applies is used to run it:
+            SLOW always runs the plain interpreted loop, a program
+            that never changes its Codebox runs as generated Python
+            code (run_specialized), with Numba installed the rest
+            runs in the compiled loop (run_compiled) and otherwise
+            in the interpreted loop.
+        '''
         self.running = True
+        try:
+            if SLOW:
+                self.run_interpreted()
+            elif SELF_MODIFYING.isdisjoint(self.code_box.ops):
+                self.run_specialized()
+            elif run_loop is not None:
+                self.run_compiled()
+            else:
+                self.run_interpreted()
+        except (IndexError, ValueError, OverflowError):
+            self.argh()
+        finally:
+            sys.stdout.flush()
+
+    def run_interpreted(self):
+        # The Codebox arrays are only changed in place, never replaced,
+        # so they can be looked up once instead of every step
+        handlers = self.code_box.handlers
+        width, height = self.code_box.width, self.code_box.height
         while self.running:
-            instruction = self.get_current_instruction()
-
-            try:
-                instruction.handle(self)
-            except Exception:
+            x, y = self.x, self.y
+            if not (0 <= x < width and 0 <= y < height):
                 self.argh()
-
-            self.advance()
+            i = y * width + x
+            handlers[i](self)
+            self.x += XOFFSET[self.dir]
+            self.y += YOFFSET[self.dir]
             if SLOW:
                 time.sleep(0.01)
 
-    def get_current_instruction(self):
-        return self.code_box.get_instruction_at(self.position)
+    def run_compiled(self):
+        '''
+            Runs the program with run_loop, the Numba compiled loop.
+            The Codebox arrays are shared with it, the stack lives
+            in a numpy array that is doubled whenever it is full.
+            Input and output instructions leave the stack as it was,
+            so those are run by their Python handlers.
+        '''
+        code_box = self.code_box
+        ops = numpy.frombuffer(code_box.ops, dtype=numpy.uint8)
+        chars = numpy.frombuffer(code_box.chars, dtype=numpy.int64)
+        table = numpy.frombuffer(OPCODE_TABLE, dtype=numpy.uint8)
+        stack = numpy.zeros(1024, dtype=numpy.int64)
+        sp = 0
+        try:
+            while self.running:
+                reason, sp, self.x, self.y, self.dir = run_loop(
+                    ops, chars, code_box.width, code_box.height, table,
+                    stack, sp, self.x, self.y, self.dir)
+
+                if reason == JIT_QUIT:
+                    self.running = False
+                elif reason == JIT_ARGH:
+                    self.argh()
+                elif reason == JIT_STACK_FULL:
+                    stack = numpy.concatenate((stack, numpy.zeros_like(stack)))
+                elif reason == JIT_HANDLE:
+                    i = code_box.index(self.x, self.y)
+                    self._dispatch[code_box.ops[i]](self)
+                    self.advance()
+        finally:
+            # run_loop left handlers and cols behind
+            code_box.sync()
+
+    def run_specialized(self):
+        '''
+            Runs a program that never changes its Codebox as blocks
+            of generated Python code (see compile_block). Blocks are
+            compiled the first time their state is reached.
+        '''
+        code_box = self.code_box
+        blocks = [None] * (code_box.width * code_box.height * 4)
+
+        def find(x, y, d, char_value):
+            x, y = code_box.find(x, y, d, char_value)
+            x += XOFFSET[d]
+            y += YOFFSET[d]
+            if not code_box.contains(x, y):
+                self.argh()
+            return (y * code_box.width + x) * 4 + d
+
+        namespace = {"argh": self.argh, "find": find, "write": self.write}
+        stack = self.stack
+        push, pop = stack.append, stack.pop
+        state = (self.y * code_box.width + self.x) * 4 + self.dir
+        while state != QUIT_STATE:
+            block = blocks[state]
+            if block is None:
+                block = blocks[state] = compile_block(code_box, state, namespace)
+            state = block(stack, push, pop)
+        self.running = False
 
-    def get_instruction_at(self, dir):
-        return self.code_box.get_instruction_at(self.position + dir)
+    def get_char_at(self, dir):
+        x, y = self.x + XOFFSET[dir], self.y + YOFFSET[dir]
+        if not self.code_box.contains(x, y):
+            self.argh()
+        return self.code_box.chars[y * self.code_box.width + x]
 
-    def set_instruction_at(self, dir, instruction):
-        self.code_box.set_instruction_at(self.position + dir, instruction)
+    def set_instruction_at(self, dir, char_value):
+        x, y = self.x + XOFFSET[dir], self.y + YOFFSET[dir]
+        if not self.code_box.contains(x, y):
+            self.argh()
+        self.code_box.set_instruction_at(x, y, char_value)
 
     def advance(self):
-        self.position += self.dir
+        self.x += XOFFSET[self.dir]
+        self.y += YOFFSET[self.dir]
 
     def turn_left(self):
-        if self.dir == NORTH:
-            self.dir = WEST
-        elif self.dir == EAST:
-            self.dir = NORTH
-        elif self.dir == SOUTH:
-            self.dir = EAST
-        elif self.dir == WEST:
-            self.dir = SOUTH
+        self.dir = (self.dir - 1) & 3
 
     def turn_right(self):
-        if self.dir == NORTH:
-            self.dir = EAST
-        elif self.dir == EAST:
-            self.dir = SOUTH
-        elif self.dir == SOUTH:
-            self.dir = WEST
-        elif self.dir == WEST:
-            self.dir = NORTH
+        self.dir = (self.dir + 1) & 3
 
     def argh(self):
         print(f"\nargh!!")
@@ -422,12 +771,11 @@ if __name__ == "__main__":
     if len(sys.argv) != 2:
         usage("File not provided!")
 
-    code_box = list()
-
     try:
-        with open(sys.argv[1], 'r') as file:
-            for line in file.readlines():
-                code_box.append(list(line))
+        with open(sys.argv[1], 'rb') as file:
+            # Split the bytes, str.splitlines also splits on
+            # characters like \f that are cells of the program
+            code_box = [row.decode() for row in file.read().splitlines()]
     except FileNotFoundError:
         usage("Input file not found!")
 